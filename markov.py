@@ -1,12 +1,17 @@
+import ast
 import random
 import logging
 import os
+import sys
+import asyncio
+import pickle
+from itertools import accumulate
 
 from dotenv import load_dotenv
 import aiogram.utils.markdown as md
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
-import json
+import orjson
 from asyncio import sleep
 
 # Replace 'YOUR_BOT_TOKEN' with your actual bot token
@@ -23,10 +28,15 @@ logging.basicConfig(level=logging.INFO)
 # Create a dictionary to store Markov chains for each chat
 markov_chain = {}
 
-# JSON file names for saving and loading Markov chains
-CHAIN_FILE = "markov_chain.json"
+# File names for saving and loading Markov chains
+CHAIN_FILE = "markov_chain.pkl"
+JOURNAL_FILE = CHAIN_FILE + ".log"
+LEGACY_CHAIN_FILE = "markov_chain.json"
 STATS_FILE = "stats.json"
 
+# Seconds between full snapshots of the chain
+SNAPSHOT_INTERVAL = 300
+
 # Set the number of words in the Markov chain
 MARKOV_ORDER = 2
 
@@ -34,37 +44,181 @@ MARKOV_ORDER = 2
 total_messages = 0
 generated_messages = 0
 
-# Function to save the Markov chain to a JSON file
-async def save_markov_chain(dispatcher):
-    logging.info('Saving Markov chain...')
-    # Convert tuple keys to strings for JSON serialization
-    serializable_chain = {str(key): value for key, value in markov_chain.items()}
-    with open(CHAIN_FILE, 'w') as file:
-        json.dump(serializable_chain, file, indent=4, ensure_ascii=False)
-    with open(STATS_FILE, 'w') as file:
-        stats = {
-            'total_msgs': total_messages,
-            'gen_msgs': generated_messages
-        }
-        json.dump(stats, file, indent=4, ensure_ascii=False)
-
-
-# Function to load the Markov chain from a JSON file and convert keys back to tuples
+# Edges (key, next_word) learned since the last journal flush
+pending_edges = []
+
+# Legacy JSON snapshots stored keys joined with the unit separator
+KEY_SEP = '\x1f'
+
+# Follower entry: occurrence counts plus lazily rebuilt sampling arrays
+def new_entry():
+    return {'counts': {}, 'words': None, 'cum': None, 'dirty': True}
+
+
+# Function to record one observed follower for a key
+def count_follower(entry, next_word):
+    counts = entry['counts']
+    counts[next_word] = counts.get(next_word, 0) + 1
+    entry['dirty'] = True
+
+
+# Function to draw a follower weighted by how often it was seen
+def sample_follower(entry):
+    if entry['dirty']:
+        counts = entry['counts']
+        entry['words'] = list(counts)
+        entry['cum'] = list(accumulate(counts.values()))
+        entry['dirty'] = False
+    return random.choices(entry['words'], cum_weights=entry['cum'], k=1)[0]
+
+
+# Function to append newly learned edges to the journal file
+def append_journal():
+    if not pending_edges:
+        return
+    with open(JOURNAL_FILE, 'ab') as file:
+        for edge in pending_edges:
+            file.write(orjson.dumps(edge) + b'\n')
+    pending_edges.clear()
+
+
+# Write bytes to a temp file and swap it in atomically, so a crash mid-write
+# never corrupts the previous snapshot
+def _replace_file(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+# Synchronous snapshot body, run off the event loop on a private copy
+def _write_snapshot(serializable_chain, stats):
+    _replace_file(CHAIN_FILE, pickle.dumps(serializable_chain, protocol=5))
+    _replace_file(STATS_FILE, orjson.dumps(stats))
+
+
+# Function to drop the journal prefix that the snapshot copy already covers;
+# runs on the event loop, where appends also happen, so nothing interleaves
+def _trim_journal(offset):
+    try:
+        with open(JOURNAL_FILE, 'rb') as file:
+            file.seek(offset)
+            tail = file.read()
+    except FileNotFoundError:
+        return
+    _replace_file(JOURNAL_FILE, tail)
+
+
+# Function to save a full snapshot of the Markov chain and trim the journal
+async def snapshot(dispatcher=None):
+    logging.info('Saving Markov chain snapshot...')
+    # Copy the chain on the event loop, with no await before the journal size
+    # is taken, so handlers cannot mutate it mid-pickle in the worker thread.
+    # Only the counts are persisted; sampling arrays are rebuilt on demand
+    serializable_chain = {key: dict(entry['counts']) for key, entry in markov_chain.items()}
+    stats = {
+        'total_msgs': total_messages,
+        'gen_msgs': generated_messages
+    }
+    try:
+        journal_offset = os.path.getsize(JOURNAL_FILE)
+    except OSError:
+        journal_offset = 0
+    await asyncio.to_thread(_write_snapshot, serializable_chain, stats)
+    # Edges journaled while the thread was writing stay in the journal
+    _trim_journal(journal_offset)
+
+
+# Background task rewriting the full snapshot every SNAPSHOT_INTERVAL seconds
+async def periodic_snapshot():
+    while True:
+        await sleep(SNAPSHOT_INTERVAL)
+        try:
+            await snapshot()
+        except Exception:
+            # Keep the timer alive; a failed snapshot retries next interval
+            logging.exception('Snapshot failed')
+
+
+# Function to replay journaled edges on top of the loaded snapshot
+def replay_journal(chain):
+    try:
+        with open(JOURNAL_FILE, 'rb') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    key, next_word = orjson.loads(line)
+                except ValueError:
+                    # A crash can tear the unfsynced final line; keep what
+                    # replayed so far instead of refusing to start
+                    logging.warning('Truncated journal line, stopping replay.')
+                    break
+                key = tuple(sys.intern(word) for word in key)
+                entry = chain.get(key)
+                if entry is None:
+                    entry = chain[key] = new_entry()
+                count_follower(entry, sys.intern(next_word))
+        logging.info('Journal replayed.')
+    except FileNotFoundError:
+        pass
+    return chain
+
+
+# Function to load a pre-pickle JSON snapshot once, for migration
+def load_legacy_chain():
+    try:
+        with open(LEGACY_CHAIN_FILE, 'rb') as file:
+            serialized_chain = orjson.loads(file.read())
+        logging.info('Legacy JSON chain file loaded.')
+        # Convert string keys back to tuples; followers had no counts yet
+        chain = {}
+        for key_str, value in serialized_chain.items():
+            if KEY_SEP in key_str:
+                key = key_str.split(KEY_SEP)
+            else:
+                # The original bot stored str(tuple) repr keys
+                try:
+                    key = ast.literal_eval(key_str)
+                except (ValueError, SyntaxError):
+                    logging.warning('Skipping unreadable chain key %r', key_str)
+                    continue
+            if len(key) != MARKOV_ORDER:
+                logging.warning('Skipping malformed chain key %r', key_str)
+                continue
+            entry = new_entry()
+            entry['counts'] = dict.fromkeys(map(sys.intern, value), 1)
+            chain[tuple(sys.intern(word) for word in key)] = entry
+        return chain
+    except FileNotFoundError:
+        logging.info('Chain file not found.')
+        return {}
+
+
+# Function to load the Markov chain snapshot
 def load_markov_chain():
     logging.info('Loading Markov chain...')
     try:
-        with open(CHAIN_FILE, 'r') as file:
-            serialized_chain = json.load(file)
-            # Convert string keys back to tuples
-            markov_chain = {eval(key): value for key, value in serialized_chain.items()}
+        with open(CHAIN_FILE, 'rb') as file:
+            # Intern so repeated words share one str object across the chain
+            markov_chain = {}
+            for key, counts in pickle.load(file).items():
+                if not isinstance(counts, dict):
+                    # Pre-counts snapshots stored plain follower sets
+                    counts = dict.fromkeys(counts, 1)
+                key = tuple(sys.intern(word) for word in key)
+                entry = new_entry()
+                entry['counts'] = {sys.intern(word): n for word, n in counts.items()}
+                markov_chain[key] = entry
         logging.info('Chain file loaded.')
     except FileNotFoundError:
-        logging.info('Chain file not found.')
-        markov_chain = {}
+        markov_chain = load_legacy_chain()
+    replay_journal(markov_chain)
     try:
-        with open(STATS_FILE, 'r') as file:
-            stats = json.load(file)
-            # Convert string keys back to tuples
+        with open(STATS_FILE, 'rb') as file:
+            stats = orjson.loads(file.read())
             total_messages = stats['total_msgs']
             generated_messages = stats['gen_msgs']
         logging.info('Stats file loaded.')
@@ -75,15 +229,30 @@ def load_markov_chain():
     return markov_chain, total_messages, generated_messages
 
 
+# Cached list of chain keys for the initial random.choice; rebuilt lazily
+# after a new key invalidates it
+_key_list_cache = None
+
+def chain_keys():
+    global _key_list_cache
+    if _key_list_cache is None:
+        _key_list_cache = list(markov_chain.keys())
+    return _key_list_cache
+
+
 # Function to generate text using a Markov chain
 def generate_markov_text(chain, max_words=50):
-    current_word = random.choice(list(chain.keys()))
+    current_word = random.choice(chain_keys())
     text = list(current_word)
 
+    # Roll the last-two-words state instead of slicing text each iteration
+    k0, k1 = current_word
     for _ in range(max_words):
-        if tuple(text[-MARKOV_ORDER:]) in chain:
-            next_word = random.choice(chain[tuple(text[-MARKOV_ORDER:])])
+        entry = chain.get((k0, k1))
+        if entry and entry['counts']:
+            next_word = sample_follower(entry)
             text.append(next_word)
+            k0, k1 = k1, next_word
         else:
             break
 
@@ -95,7 +264,7 @@ async def wisdom(message: types.Message):
     global total_messages
     global generated_messages
     total_words = len(markov_chain)
-    chain_size = sum(len(values) for values in markov_chain.values())
+    chain_size = sum(len(entry['counts']) for entry in markov_chain.values())
     
     stats_message = (
         f"Total Messages: {total_messages}\n"
@@ -111,20 +280,27 @@ async def wisdom(message: types.Message):
 async def on_message(message: types.Message):
     logging.info('Logged message...')
     global total_messages
+    global _key_list_cache
     total_messages += 1
 
     chat_id = message.chat.id
 
-    # Update the Markov chain for the chat
-    text = message.text.split()
+    # Update the Markov chain for the chat; intern words so repeats across
+    # messages share one str object
+    text = [sys.intern(word) for word in message.text.split()]
     text.append("")  # Add an empty string to the end
-    for i in range(len(text) - MARKOV_ORDER):
-        key = tuple(text[i:i+MARKOV_ORDER])
-        if key not in markov_chain:
-            markov_chain[key] = []
-        if text[i + MARKOV_ORDER] not in markov_chain[key]:
-            markov_chain[key].append(text[i + MARKOV_ORDER])
-    
+    # C-level iteration over (w[i], w[i+1], w[i+2]) triples; MARKOV_ORDER == 2
+    for w0, w1, next_word in zip(text, text[1:], text[2:]):
+        key = (w0, w1)
+        entry = markov_chain.get(key)
+        if entry is None:
+            entry = markov_chain[key] = new_entry()
+            _key_list_cache = None
+        count_follower(entry, next_word)
+        # Every occurrence is journaled so replay rebuilds the counts
+        pending_edges.append((key, next_word))
+    append_journal()
+
     # Occasionally generate and send Markov-generated text
     if not (('@mudrets_robot' in message.text) or (message.chat.type == 'private') or (message.text == 'мудрец')):
         if random.random() > 0.1:
@@ -135,11 +311,14 @@ async def on_message(message: types.Message):
     generated_messages += 1
     generated_text = generate_markov_text(markov_chain, 100)
     await message.reply(generated_text)
-    await save_markov_chain(dp)
 
 
+# Start the periodic snapshot task once the event loop is running
+async def on_startup(dispatcher):
+    asyncio.create_task(periodic_snapshot())
+
 
 if __name__ == '__main__':
     markov_chain, total_messages, generated_messages = load_markov_chain()  # Load Markov chain on startup
     from aiogram import executor
-    executor.start_polling(dp, skip_updates=True, on_shutdown=save_markov_chain)  # Save Markov chain on shutdown
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=snapshot)  # Save Markov chain on shutdown
@@ -1,14 +1,16 @@
+import ast
 import random
 import logging
 import asyncio
 import os
+import queue
+import sqlite3
+import sys
+import threading
 
+import orjson
 from dotenv import load_dotenv
-from contextlib import asynccontextmanager
-from typing import List, Tuple, Optional, AsyncGenerator
-from sqlalchemy import Column, String, Integer, func, select, update
-from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.types import Message
@@ -24,8 +26,12 @@ if not REPLY_CHANCE:
     raise RuntimeError("REPLY_CHANCE must be set in .env")
 MARKOV_ORDER = 2
 MAX_WORDS = 100
-DATABASE_URL = "sqlite+aiosqlite:///markov_chain.db"
+# Chain keys are words joined with the unit separator, which split() never yields
+KEY_SEP = "\x1f"
+DATABASE_PATH = "markov_chain.db"
 SAVE_INTERVAL = 300
+# Max statements the DB worker folds into a single transaction
+DB_BATCH_SIZE = 64
 
 # Initialize logging
 logging.basicConfig(
@@ -34,117 +40,284 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-Base = declarative_base()
+# SQLite ships with a rollback journal and synchronous=FULL, which fsyncs on
+# every commit; WAL + NORMAL plus a bigger cache and mmap suit this write-heavy
+# workload much better
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA wal_autocheckpoint=1000",
+)
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS chain (key TEXT PRIMARY KEY, next_words TEXT)",
+    "CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER)",
+)
+
+class Database:
+    """Single background thread owning one sqlite3 connection.
+
+    aiosqlite pays an executor round-trip per statement; here requests are
+    queued as (mode, sql, params, future) and the worker folds up to
+    DB_BATCH_SIZE of them into one BEGIN IMMEDIATE/COMMIT, resolving the
+    futures back on the event loop.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._thread = threading.Thread(target=self._worker, name="db-worker", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._queue.put(None)
+        if self._thread:
+            await asyncio.to_thread(self._thread.join)
+
+    def _submit(self, mode: str, sql: str, params: Any) -> "asyncio.Future":
+        future = self._loop.create_future()
+        self._queue.put((mode, sql, params, future))
+        return future
+
+    async def exec(self, sql: str, params: Sequence = ()) -> int:
+        return await self._submit("exec", sql, params)
+
+    async def exec_many(self, sql: str, rows: Sequence[Sequence]) -> int:
+        return await self._submit("many", sql, rows)
+
+    async def fetchone(self, sql: str, params: Sequence = ()) -> Optional[tuple]:
+        return await self._submit("one", sql, params)
 
-# SQLAlchemy Models
-class Chain(Base):
-    __tablename__ = "chain"
-    key = Column(String, primary_key=True)
-    next_words = Column(String)
+    async def fetchall(self, sql: str, params: Sequence = ()) -> List[tuple]:
+        return await self._submit("all", sql, params)
 
-class Stat(Base):
-    __tablename__ = "stats"
-    key = Column(String, primary_key=True)
-    value = Column(Integer)
+    @staticmethod
+    def _resolve(future: "asyncio.Future", result: Any, exc: Optional[Exception]) -> None:
+        if future.done():
+            return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
 
-# Async engine and session
-engine = create_async_engine(DATABASE_URL)
-async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    def _worker(self) -> None:
+        conn = sqlite3.connect(self._path, isolation_level=None, check_same_thread=False)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        for ddl in SCHEMA:
+            conn.execute(ddl)
+
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < DB_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            jobs = [job for job in batch if job is not None]
+            running = len(jobs) == len(batch)
+            if not jobs:
+                continue
+
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.Error as error:
+                for _, _, _, future in jobs:
+                    self._loop.call_soon_threadsafe(self._resolve, future, None, error)
+                continue
+            for mode, sql, params, future in jobs:
+                result, exc = None, None
+                try:
+                    cursor = conn.executemany(sql, params) if mode == "many" else conn.execute(sql, params)
+                    if mode == "one":
+                        result = cursor.fetchone()
+                    elif mode == "all":
+                        result = cursor.fetchall()
+                    else:
+                        result = cursor.rowcount
+                except Exception as error:
+                    exc = error
+                self._loop.call_soon_threadsafe(self._resolve, future, result, exc)
+            try:
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                logger.exception("Commit failed, rolling back batch")
+                conn.execute("ROLLBACK")
+        conn.close()
+
+db = Database(DATABASE_PATH)
 
 # Bot setup
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
-@asynccontextmanager
-async def get_session() -> AsyncGenerator[AsyncSession, None]:
-    async with async_session() as session:
-        try:
-            yield session
-            await session.commit()
-        except Exception:
-            await session.rollback()
-            raise
-
-async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    logger.info("Database initialized")
-
-async def update_stat(key: str, value: int) -> None:
-    async with get_session() as session:
-        stmt = (
-            update(Stat)
-            .where(Stat.key == key)
-            .values(value=value)
-            .execution_options(synchronize_session="fetch")
-        )
-        await session.execute(stmt)
+# Message counters live in memory — bumping two integers was otherwise the
+# highest-frequency DB access in the bot — and are flushed on a timer
+_total_messages = 0
+_generated_messages = 0
+
+# Chain shape counters, maintained as edges are learned so /wisdom does not
+# have to scan every next_words string; seeded from the in-memory chain
+_chain_count = 0
+_chain_size = 0
+
+# The full chain mirrored in memory: generation walks this dict with no I/O,
+# and build_markov_chain writes new edges through to SQLite in the background
+CHAIN_MEM: Dict[Tuple[str, ...], Set[str]] = {}
+
+# Cached list of chain keys for the opening random.choice; rebuilt lazily
+# after a new key invalidates it
+_key_list_cache: Optional[List[Tuple[str, ...]]] = None
+
+# Per-key follower tuples cached for O(1) random.choice during generation;
+# an insert for a key invalidates its entry
+_follower_cache: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+# Strong refs to in-flight write-through tasks; the event loop itself keeps
+# only weak ones, so an untracked task can be collected before it runs
+_pending_writes: Set["asyncio.Task"] = set()
+
+def _write_done(task: "asyncio.Task") -> None:
+    _pending_writes.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error("Chain write-through failed", exc_info=task.exception())
+
+def chain_keys() -> List[Tuple[str, ...]]:
+    global _key_list_cache
+    if _key_list_cache is None:
+        _key_list_cache = list(CHAIN_MEM.keys())
+    return _key_list_cache
+
+STATS_UPSERT = (
+    "INSERT INTO stats (key, value) VALUES (?, ?) "
+    "ON CONFLICT (key) DO UPDATE SET value = excluded.value"
+)
 
 async def get_stat(key: str) -> int:
-    async with get_session() as session:
-        result = await session.execute(select(Stat.value).where(Stat.key == key))
-        return result.scalar() or 0
+    row = await db.fetchone("SELECT value FROM stats WHERE key = ?", (key,))
+    return row[0] if row else 0
 
-async def build_markov_chain(words: List[str]) -> None:
-    words = words + [""]
-    async with get_session() as session:
-        for i in range(len(words) - MARKOV_ORDER):
-            key = tuple(words[i:i + MARKOV_ORDER])
-            next_word = words[i + MARKOV_ORDER]
-            key_str = str(key)
-
-            # Get or create chain entry
-            chain_entry = await session.get(Chain, key_str)
-            if chain_entry:
-                next_words = eval(chain_entry.next_words)
-                if next_word not in next_words:
-                    next_words.append(next_word)
-                    chain_entry.next_words = str(next_words)
-            else:
-                session.add(Chain(key=key_str, next_words=str([next_word])))
-
-async def get_random_key() -> Tuple[str, ...]:
-    async with get_session() as session:
-        result = await session.execute(
-            select(Chain.key).order_by(func.random()).limit(1)
+async def flush_stats() -> None:
+    await db.exec_many(STATS_UPSERT, [
+        ("total_messages", _total_messages),
+        ("generated_messages", _generated_messages),
+    ])
+
+# One statement upserts every n-gram of a message; list manipulation happens
+# inside SQLite via its JSON functions instead of a fetch/decode/append per key.
+# The dedup guard compares whole array elements via json_each — a substring
+# test on the JSON text false-positives when a stored follower contains quotes
+CHAIN_UPSERT = (
+    "INSERT INTO chain (key, next_words) VALUES (?, json_array(?)) "
+    "ON CONFLICT (key) DO UPDATE SET next_words = CASE "
+    "WHEN NOT EXISTS (SELECT 1 FROM json_each(next_words) WHERE json_each.value = ?) "
+    "THEN json_insert(next_words, '$[#]', ?) "
+    "ELSE next_words END"
+)
+
+async def load_chain() -> None:
+    global _chain_count, _chain_size
+    rows = await db.fetchall("SELECT key, next_words FROM chain")
+    legacy_keys = []
+    for key_str, next_words in rows:
+        if KEY_SEP in key_str:
+            key = tuple(key_str.split(KEY_SEP))
+            followers = orjson.loads(next_words)
+        else:
+            # Rows written before the format change stored str(tuple) keys
+            # and str(list) follower lists; read them once and rewrite below
+            try:
+                key = tuple(ast.literal_eval(key_str))
+                followers = ast.literal_eval(next_words)
+            except (ValueError, SyntaxError):
+                logger.warning("Skipping unreadable chain row %r", key_str)
+                continue
+            legacy_keys.append((key_str, key))
+        # Intern so repeated words share one str object across the chain
+        key = tuple(sys.intern(word) for word in key)
+        CHAIN_MEM.setdefault(key, set()).update(map(sys.intern, followers))
+    if legacy_keys:
+        await db.exec_many(
+            "DELETE FROM chain WHERE key = ?",
+            [(old_key_str,) for old_key_str, _ in legacy_keys],
         )
-        key = result.scalar()
-        return eval(key) if key else ("start", "here")
-
-async def generate_text(max_words: int = MAX_WORDS) -> str:
-    async with get_session() as session:
-        current_key = await get_random_key()
-        result = list(current_key)
-
-        for _ in range(max_words):
-            key_str = str(tuple(result[-MARKOV_ORDER:]))
-            chain_entry = await session.get(Chain, key_str)
-            
-            if not chain_entry or not chain_entry.next_words:
-                break
-
-            next_words = eval(chain_entry.next_words)
-            next_word = random.choice(next_words)
-            result.append(next_word)
-            
-            if not next_word:
-                break
-
-        return " ".join(result).strip()
+        await db.exec_many(
+            "INSERT OR REPLACE INTO chain (key, next_words) VALUES (?, ?)",
+            [(KEY_SEP.join(key), orjson.dumps(list(CHAIN_MEM[key])).decode())
+             for _, key in legacy_keys],
+        )
+        logger.info("Migrated %d legacy chain rows", len(legacy_keys))
+    _chain_count = len(CHAIN_MEM)
+    _chain_size = sum(len(followers) for followers in CHAIN_MEM.values())
+    logger.info("Loaded %d chain keys", _chain_count)
+
+async def build_markov_chain(words: List[str]) -> None:
+    global _chain_count, _chain_size, _key_list_cache
+
+    words = [sys.intern(word) for word in words] + [""]
+    new_rows = []
+    # C-level iteration over (w[i], w[i+1], w[i+2]) triples; MARKOV_ORDER == 2
+    for w0, w1, next_word in zip(words, words[1:], words[2:]):
+        key = (w0, w1)
+        followers = CHAIN_MEM.get(key)
+        if followers is None:
+            followers = CHAIN_MEM[key] = set()
+            _key_list_cache = None
+            _chain_count += 1
+        if next_word not in followers:
+            followers.add(next_word)
+            _follower_cache.pop(key, None)
+            _chain_size += 1
+            key_str = KEY_SEP.join(key)
+            new_rows.append((key_str, next_word, next_word, next_word))
+
+    if new_rows:
+        # Write-through in the background; the reply path no longer waits on it
+        task = asyncio.create_task(db.exec_many(CHAIN_UPSERT, new_rows))
+        _pending_writes.add(task)
+        task.add_done_callback(_write_done)
+
+def get_random_key() -> Tuple[str, ...]:
+    keys = chain_keys()
+    return random.choice(keys) if keys else ("start", "here")
+
+def generate_text(max_words: int = MAX_WORDS) -> str:
+    result = list(get_random_key())
+
+    # Roll the last-two-words state instead of re-joining a key each iteration
+    k0, k1 = result[-2], result[-1]
+    for _ in range(max_words):
+        key = (k0, k1)
+        followers = CHAIN_MEM.get(key)
+        if not followers:
+            break
+
+        cached = _follower_cache.get(key)
+        if cached is None:
+            cached = _follower_cache[key] = tuple(followers)
+        next_word = random.choice(cached)
+        result.append(next_word)
+
+        if not next_word:
+            break
+        k0, k1 = k1, next_word
+
+    return " ".join(result).strip()
 
 @dp.message(Command("wisdom", "мудрость"))
 async def wisdom_command(message: Message) -> None:
-    total_messages = await get_stat("total_messages")
-    generated_messages = await get_stat("generated_messages")
-    
-    async with get_session() as session:
-        chain_count = await session.scalar(select(func.count(Chain.key)))
-        chain_size = await session.scalar(
-            select(func.sum(
-                func.length(Chain.next_words) - 
-                func.length(func.replace(Chain.next_words, ',', '')) + 1
-            ))
-        )
+    total_messages = _total_messages
+    generated_messages = _generated_messages
+    chain_count, chain_size = _chain_count, _chain_size
 
     variability = chain_size / chain_count if chain_count > 0 else 0
     stats_message = (
@@ -158,53 +331,61 @@ async def wisdom_command(message: Message) -> None:
 
 @dp.message(F.text)
 async def handle_message(message: Message) -> None:
+    global _total_messages, _generated_messages
+
     # Update message count
-    total = await get_stat("total_messages") + 1
-    await update_stat("total_messages", total)
-    
+    _total_messages += 1
+
     # Process message
     await build_markov_chain(message.text.split())
 
     # Check triggers
+    text_lower = message.text.lower()
     trigger_conditions = (
         message.chat.type == 'private' or
-        message.text.lower() == 'мудрец' or
-        '@mudrets_robot' in message.text.lower()
+        text_lower == 'мудрец' or
+        '@mudrets_robot' in text_lower
     )
 
     if not trigger_conditions and random.random() > REPLY_CHANCE:
         return
 
     await asyncio.sleep(random.uniform(1, 3))
-    generated_text = await generate_text()
-    
+    generated_text = generate_text()
+
     # Update generated count
-    generated = await get_stat("generated_messages") + 1
-    await update_stat("generated_messages", generated)
-    
+    _generated_messages += 1
+
     await message.reply(generated_text)
 
 async def periodic_save():
     while True:
         await asyncio.sleep(SAVE_INTERVAL)
-        async with engine.begin() as conn:
-            await conn.commit()
-        logger.info("Database changes committed")
+        await flush_stats()
+        logger.info("Stats flushed")
 
 async def on_startup():
-    await init_db()
+    global _total_messages, _generated_messages
+    db.start(asyncio.get_running_loop())
+    _total_messages = await get_stat("total_messages")
+    _generated_messages = await get_stat("generated_messages")
+    await load_chain()
     asyncio.create_task(periodic_save())
     logger.info("Bot started")
 
 async def on_shutdown():
-    await engine.dispose()
+    # Let queued write-throughs reach the worker before its stop sentinel
+    if _pending_writes:
+        await asyncio.gather(*_pending_writes, return_exceptions=True)
+    await flush_stats()
+    await db.stop()
     logger.info("Bot stopped")
 
 if __name__ == "__main__":
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
-    
+
     try:
         asyncio.run(dp.start_polling(bot, skip_updates=True))
     except KeyboardInterrupt:
-        logger.info("Bot stopped by keyboard interrupt")
\ No newline at end of file
+        logger.info("Bot stopped by keyboard interrupt")